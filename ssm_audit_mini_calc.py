@@ -12,29 +12,39 @@ Canonicals (ASCII):
   SDI (portfolio): a_sdi := tanh( (SUM atanh(a_i)) / n )
 """
 
-import argparse, csv, json, hashlib, math, os, sys
-from collections import defaultdict, deque
+import argparse, bisect, csv, functools, io, json, hashlib, math, os, sys
+from collections import defaultdict
 from datetime import datetime, timezone, timedelta
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Tuple
 
 # ---------- helpers ----------
 def clamp(x, lo, hi):
     return lo if x < lo else hi if x > hi else x
 
 SCORE = {"A--":1,"A-":2,"A0":3,"A+":4,"A++":5}
+BANDS = ("A--","A-","A0","A+","A++")  # index = SCORE-1
+BAND_TH = (0.10, 0.25, 0.50, 0.75)    # lower edges of A-, A0, A+, A++
 
 def band_from_a(a: float) -> str:
-    if a >= 0.75: return "A++"
-    elif a >= 0.50: return "A+"
-    elif a >= 0.25: return "A0"
-    elif a >= 0.10: return "A-"
-    else: return "A--"
+    if a != a: return "A--"  # NaN sits below every threshold
+    return BANDS[bisect.bisect_right(BAND_TH, a)]
+
+def parse_float(x, default=None):
+    try:
+        return float(x)
+    except Exception:
+        return default
 
 def canonical_json(d: Dict) -> str:
     return json.dumps(d, sort_keys=True, separators=(",", ":"))
 
 def sha256_ascii(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+    data = s.encode("utf-8")
+    try:
+        # fingerprint, not a security boundary: skip FIPS guards (Python 3.9+)
+        return hashlib.sha256(data, usedforsecurity=False).hexdigest()
+    except TypeError:
+        return hashlib.sha256(data).hexdigest()
 
 def knobs_hash_from(knobs: Dict) -> str:
     return sha256_ascii(canonical_json(knobs))
@@ -43,6 +53,11 @@ def parse_iso(ts: str) -> datetime:
     if not ts:
         # UTC, date-only
         return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).replace(tzinfo=None)
+    return _parse_iso_cached(ts)
+
+# timestamps repeat across KPIs and sorts; parse each distinct string once
+@functools.lru_cache(maxsize=None)
+def _parse_iso_cached(ts: str) -> datetime:
     if "T" in ts:
         return datetime.fromisoformat(ts.replace("Z","+00:00")).replace(tzinfo=None)
     try:
@@ -51,6 +66,42 @@ def parse_iso(ts: str) -> datetime:
         return datetime.fromisoformat(ts)
 
 # ---------- compute-a mappers ----------
+def _build_mapper(mapper: str, eps_a: float, col: Dict[str,int],
+                  missing: int) -> Callable[[List[str]], Tuple[float, str]]:
+    # specialize one mapper for a fixed column layout: dispatch and column
+    # positions are resolved once; absent columns read values[missing]
+    lo, hi = -1+eps_a, 1-eps_a
+    ix = lambda name: col.get(name, missing)
+    if mapper == "coverage":
+        i_q = ix("q")
+        def fn(v):
+            a = 2.0*float(v[i_q]) - 1.0
+            return (lo if a < lo else hi if a > hi else a, "coverage")
+    elif mapper == "agreement":
+        i_m1, i_m2, i_b = ix("m1"), ix("m2"), ix("b")
+        def fn(v):
+            m1 = float(v[i_m1]); m2 = float(v[i_m2]); b = float(v[i_b])
+            if b <= 0: return (None, "agreement:b<=0")
+            a = math.tanh(1.0 - abs(m1 - m2)/b)
+            return (lo if a < lo else hi if a > hi else a, "agreement")
+    elif mapper == "residual":
+        i_act, i_fc, i_s, i_k = ix("actual"), ix("forecast"), ix("s"), ix("k")
+        def fn(v):
+            actual = float(v[i_act]); forecast = float(v[i_fc]); s = float(v[i_s])
+            if s <= 0: return (None, "residual:s<=0")
+            k = float(v[i_k] or 1.0)
+            a = math.tanh(k*(1.0 - abs(actual - forecast)/s))
+            return (lo if a < lo else hi if a > hi else a, "residual")
+    else:
+        return lambda v: (None, "no-mapper")
+
+    def guarded(v):
+        try:
+            return fn(v)
+        except Exception as e:
+            return (None, f"mapper-error:{mapper}:{e}")
+    return guarded
+
 def compute_a_from_mapper(row: Dict, eps_a: float) -> Tuple[float, str]:
     mapper = (row.get("mapper","") or "").strip().lower()
     try:
@@ -77,22 +128,38 @@ def compute_a_from_mapper(row: Dict, eps_a: float) -> Tuple[float, str]:
         return (None, f"mapper-error:{mapper}:{e}")
 
 # ---------- hysteresis ----------
+def _hyst_score(prev: int, raw: int, d: float, promote: float, demote: float) -> int:
+    # move to the raw score only if a shifted far enough in that direction
+    if (raw > prev and d >= promote) or (raw < prev and d <= demote): return raw
+    return prev
+
 def next_band(prev_band: str, a_prev: float, a_now: float, promote: float, demote: float) -> str:
-    raw = band_from_a(a_now)
+    raw = SCORE[band_from_a(a_now)]
     d = a_now - (a_prev if a_prev is not None else a_now)
-    if SCORE[raw] > SCORE.get(prev_band, SCORE[raw]) and d >= promote: return raw
-    if SCORE[raw] < SCORE.get(prev_band, SCORE[raw]) and d <= demote:  return raw
-    return prev_band or raw
+    prev = SCORE.get(prev_band, raw)
+    sc = _hyst_score(prev, raw, d, promote, demote)
+    return BANDS[sc-1] if sc != prev else (prev_band or BANDS[raw-1])
+
+def hysteresis_bands(a_seq: List[float], promote: float, demote: float) -> List[str]:
+    # next_band over a whole time-sorted KPI series, on integer scores
+    scores, prev, a_prev = [], 0, 0.0
+    bisect_right, th = bisect.bisect_right, BAND_TH
+    for a in a_seq:
+        raw = bisect_right(th, a) + 1 if a == a else 1
+        if prev:
+            raw = _hyst_score(prev, raw, a - a_prev, promote, demote)
+        scores.append(raw)
+        prev, a_prev = raw, a
+    return [BANDS[sc-1] for sc in scores]
 
 # ---------- alerts ----------
 def compute_alerts(rows_sorted: List[Dict], slope_7d: float=-0.02) -> List[Dict]:
-    alerts, win = [], deque(maxlen=3)
-    for r in rows_sorted:
-        win.append(SCORE[r["band_hyst"]])
-        if len(win) == 3:
-            drops = (win[2] < win[1]) + (win[1] < win[0]) + (win[2] < win[0])
-            if drops >= 2:
-                alerts.append({"time": r["time"], "kpi": r["kpi"], "rule":"degrade_2of3"})
+    alerts = []
+    # scores once per series; degrade_2of3 over each 3-row window (s0,s1,s2)
+    sc = [SCORE[r["band_hyst"]] for r in rows_sorted]
+    for r, s0, s1, s2 in zip(rows_sorted[2:], sc, sc[1:], sc[2:]):
+        if (s2 < s1) + (s1 < s0) + (s2 < s0) >= 2:
+            alerts.append({"time": r["time"], "kpi": r["kpi"], "rule":"degrade_2of3"})
     if len(rows_sorted) >= 8:
         a0, a7 = rows_sorted[-8]["a"], rows_sorted[-1]["a"]
         slope = (a7 - a0) / 7.0
@@ -103,12 +170,26 @@ def compute_alerts(rows_sorted: List[Dict], slope_7d: float=-0.02) -> List[Dict]
 
 # ---------- plotting ----------
 try:
+    import matplotlib
+    if "MPLBACKEND" not in os.environ:
+        matplotlib.use("Agg")  # files only: skip interactive backend probing
     import matplotlib.pyplot as plt
     import matplotlib.dates as mdates
     HAVE_PLOT = True
 except Exception:
     HAVE_PLOT = False
 
+_FIGS: Dict[Tuple[float,float], object] = {}
+
+def _figure(figsize: Tuple[float,float]):
+    # one reusable figure per size, cleared between plots
+    fig = _FIGS.get(figsize)
+    if fig is None or not plt.fignum_exists(fig.number):
+        fig = _FIGS[figsize] = plt.figure(figsize=figsize)
+    else:
+        fig.clf()
+    return fig
+
 def plot_kpi(rows_sorted: List[Dict], kpi: str, out_dir: str,
              color_m: str="tab:blue", color_a: str="tab:orange",
              tag: str=None, keep_plain: bool=False) -> str:
@@ -120,7 +201,8 @@ def plot_kpi(rows_sorted: List[Dict], kpi: str, out_dir: str,
     m  = [float(r["m"]) for r in rows_sorted]
     a  = [float(r["a"]) for r in rows_sorted]
 
-    fig, ax1 = plt.subplots(figsize=(12,4))
+    fig = _figure((12,4))
+    ax1 = fig.add_subplot(111)
     ax1.plot(ts, m, label=f"m (classical: {kpi})", linewidth=2, color=color_m, zorder=3)
     ax1.set_xlabel("time"); ax1.set_ylabel("m")
     ax1.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
@@ -149,58 +231,62 @@ def plot_kpi(rows_sorted: List[Dict], kpi: str, out_dir: str,
     fig.savefig(path_tagged, dpi=150)
     if keep_plain and tagged != base:
         fig.savefig(os.path.join(out_dir, base), dpi=150)
-    plt.close(fig)
     return path_tagged
 
 # ---------- SDI helper (native) ----------
 # a_sdi := tanh( (SUM atanh(a_i)) / n )
 def append_sdi_rows_from_csv(output_csv_path: str, eps_a: float, sdi_kpis: str,
                              sdi_csv: str, do_plot: bool, plots_dir: str):
-    def _clamp(a, eps):
-        if a > 1.0 - eps: return 1.0 - eps
-        if a < -1.0 + eps: return -1.0 + eps
-        return a
     def _norm(name: str) -> str:
         return (name or "").strip().strip('"').strip("'")
 
-    # read & purge existing SDI rows
-    header, base_rows = None, []
-    with open(output_csv_path, "r", encoding="utf-8") as f:
-        rdr = csv.DictReader(f)
-        header = rdr.fieldnames or ["time","kpi","m","a","band","band_hyst","knobs_hash","build_id","stamp"]
+    fields = ["time","kpi","m","a","band","band_hyst","knobs_hash","build_id","stamp"]
+
+    # read & purge existing SDI rows (rows kept as lists in header order)
+    base_rows = []
+    with open(output_csv_path, "r", newline="", encoding="utf-8") as f:
+        rdr = csv.reader(f)
+        header = next(rdr, None) or fields
+        n = len(header)
+        col = {h: i for i, h in enumerate(header)}
+        ix_k = col.get("kpi")
         for r in rdr:
-            if (r.get("kpi","") or "") == "SDI":
+            if not r:
+                continue
+            if len(r) != n:
+                r = (r + [""]*n)[:n]
+            if ix_k is not None and r[ix_k] == "SDI":
                 continue
             base_rows.append(r)
 
+    def _column(name: str) -> List[str]:
+        ix = col.get(name)
+        return [r[ix] for r in base_rows] if ix is not None else [""]*len(base_rows)
+
     # robust filter: strip quotes/spaces around tokens
     filt = set(_norm(s) for s in (sdi_kpis or "").split(",") if _norm(s))
 
-    # collect a-values per day after optional KPI filter
-    per_day = defaultdict(list)
-    for r in base_rows:
-        kpi = _norm(r.get("kpi",""))
-        if filt and kpi not in filt:
+    # rapidity sum and count per day after optional KPI filter, in one pass
+    atanh, tanh = math.atanh, math.tanh
+    lo, hi = -1.0 + eps_a, 1.0 - eps_a
+    u_sum: Dict[str, float] = {}
+    n_day: Dict[str, int] = {}
+    for t, kpi, a_str in zip(_column("time"), _column("kpi"), _column("a")):
+        if filt and _norm(kpi) not in filt:
             continue
-        t = r.get("time","")
         if not t:
             continue
-        try:
-            a_val = float(r.get("a",""))
-        except Exception:
+        a_val = parse_float(a_str)
+        if a_val is None:
             continue
-        per_day[t].append(a_val)
+        a_val = lo if a_val < lo else hi if a_val > hi else a_val
+        u_sum[t] = u_sum.get(t, 0.0) + atanh(a_val)
+        n_day[t] = n_day.get(t, 0) + 1
 
     # compute SDI rows
     sdi_rows = []
-    for t in sorted(per_day.keys()):
-        a_list = per_day[t]
-        if not a_list:
-            continue
-        u_sum = 0.0
-        for ai in a_list:
-            u_sum += math.atanh(_clamp(ai, eps_a))
-        a_sdi = math.tanh(u_sum / max(len(a_list), 1))
+    for t in sorted(u_sum):
+        a_sdi = tanh(u_sum[t] / n_day[t])
         sdi_rows.append({
             "time": t, "kpi": "SDI", "m": "0.0", "a": f"{a_sdi:.10f}",
             "band": band_from_a(a_sdi), "band_hyst": band_from_a(a_sdi),
@@ -209,27 +295,25 @@ def append_sdi_rows_from_csv(output_csv_path: str, eps_a: float, sdi_kpis: str,
 
     # write purged + SDI
     with open(output_csv_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=header)
-        w.writeheader()
-        for r in base_rows:
-            w.writerow(r)
-        for r in sdi_rows:
-            w.writerow(r)
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(base_rows)
+        w.writerows([r.get(h, "") for h in header] for r in sdi_rows)
 
     # optional SDI-only CSV
     if sdi_csv:
         with open(sdi_csv, "w", newline="", encoding="utf-8") as f:
-            w = csv.DictWriter(f, fieldnames=["time","kpi","m","a","band","band_hyst","knobs_hash","build_id","stamp"])
-            w.writeheader()
-            for r in sdi_rows:
-                w.writerow(r)
+            w = csv.writer(f)
+            w.writerow(fields)
+            w.writerows([r[h] for h in fields] for r in sdi_rows)
 
     # optional SDI plot
     if do_plot and HAVE_PLOT and sdi_rows:
         try:
             xs = [r["time"] for r in sdi_rows]
             ys = [float(r["a"]) for r in sdi_rows]
-            fig, ax = plt.subplots(figsize=(10,3.5))
+            fig = _figure((10,3.5))
+            ax = fig.add_subplot(111)
             ax.plot(xs, ys, marker="o")
             ax.set_title("SDI (tanh-mean of lanes)")
             ax.set_xlabel("time"); ax.set_ylabel("a_sdi")
@@ -238,12 +322,12 @@ def append_sdi_rows_from_csv(output_csv_path: str, eps_a: float, sdi_kpis: str,
             os.makedirs(plots_dir, exist_ok=True)
             out_path = os.path.join(plots_dir, "SDI.png")
             fig.savefig(out_path, dpi=150)
-            plt.close(fig)
             print(f"[OK] SDI plot: {out_path}")
         except Exception as e:
             print(f"[WARN] SDI plot skipped: {e}")
 
     print(f"[OK] SDI appended: {len(sdi_rows)} rows")
+    return sdi_rows
 
 # ---------- DEMO generator ----------
 def demo_rows(start_iso: str, days: int, eps_a: float) -> List[Dict]:
@@ -254,31 +338,32 @@ def demo_rows(start_iso: str, days: int, eps_a: float) -> List[Dict]:
     b     = 0.005
     q0    = 0.88
 
-    for i in range(days):
-        t = (start + timedelta(days=i)).strftime("%Y-%m-%d")
-
-        # Revenue_actual (smooth ramp; one mid-curve miss)
-        forecast = 1_000_000 + 30_000*i
-        actual   = forecast + (20_000 if i==6 else (-10_000 if i<3 else 5_000))
-        r = actual - forecast
-        a_res = math.tanh(k*(1 - abs(r)/s))
-        out.append({"time":t,"kpi":"Revenue_actual","m":float(actual),
-                    "a": clamp(a_res, -1+eps_a, 1-eps_a)})
-
-        # AR_collected_issued (coverage easing then recovering)
-        q = q0 + 0.01*i if i<3 else q0 + 0.03 - 0.008*(i-3)
-        q = max(0.0, min(1.0, q))
-        a_cov = 2*q - 1
-        out.append({"time":t,"kpi":"AR_collected_issued","m":0.96,
-                    "a": clamp(a_cov, -1+eps_a, 1-eps_a)})
-
-        # Refunds_agreement (drift then re-align)
-        m_platform = 0.021 + 0.0002*i
-        m_bank     = 0.020 + (0.0004*i if i<5 else 0.00005*i)
-        d = abs(m_platform - m_bank)
-        a_agree = math.tanh(1 - d/b)
-        out.append({"time":t,"kpi":"Refunds_agreement","m":m_platform,
-                    "a": clamp(a_agree, -1+eps_a, 1-eps_a)})
+    lo, hi = -1+eps_a, 1-eps_a
+    tanh  = math.tanh  # exact libm; a Python-level approximation is slower
+    idx   = range(days)
+    times = [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in idx]
+
+    # Revenue_actual (smooth ramp; one mid-curve miss)
+    forecast = [1_000_000 + 30_000*i for i in idx]
+    actual   = [f + (20_000 if i==6 else (-10_000 if i<3 else 5_000)) for i, f in zip(idx, forecast)]
+    a_res    = [clamp(tanh(k*(1 - abs(x - f)/s)), lo, hi) for x, f in zip(actual, forecast)]
+
+    # AR_collected_issued (coverage easing then recovering)
+    q     = [max(0.0, min(1.0, q0 + 0.01*i if i<3 else q0 + 0.03 - 0.008*(i-3))) for i in idx]
+    a_cov = [clamp(2*qi - 1, lo, hi) for qi in q]
+
+    # Refunds_agreement (drift then re-align)
+    m_platform = [0.021 + 0.0002*i for i in idx]
+    m_bank     = [0.020 + (0.0004*i if i<5 else 0.00005*i) for i in idx]
+    a_agree    = [clamp(tanh(1 - abs(mp - mb)/b), lo, hi) for mp, mb in zip(m_platform, m_bank)]
+
+    # rows are emitted day-major (three KPIs per day) to keep downstream ordering stable
+    for t, m_rev, a_r, a_c, m_p, a_g in zip(times, actual, a_res, a_cov, m_platform, a_agree):
+        out.extend((
+            {"time":t, "kpi":"Revenue_actual",      "m":float(m_rev), "a":a_r},
+            {"time":t, "kpi":"AR_collected_issued", "m":0.96,         "a":a_c},
+            {"time":t, "kpi":"Refunds_agreement",   "m":m_p,          "a":a_g},
+        ))
     return out
 
 # ---------- main ----------
@@ -334,11 +419,37 @@ def main():
     }
     khash = knobs_hash_from(knobs)
 
-    # --- Build rows: DEMO or CSV ---
-    rows: List[Dict] = []
+    # --- Build input columns (SoA): DEMO or CSV ---
+    times:     List[str]   = []   # raw time string per input row
+    kpis:      List[str]   = []
+    m_raw:     List        = []   # explicit m (str or float), "" if absent
+    a_col:     List[float] = []   # clamped a
+    w_col:     List[float] = []   # fuse weight (default 1)
+    src:       List        = []   # source row (demo dict / CSV values), for m tie-breaks
+    raw_header: List[str]  = []
+    lo, hi = -1+args.eps_a, 1-args.eps_a  # a clamp bounds, hoisted for the row loops
+
+    def canonical_row(i: int) -> str:
+        # canonical_json of input row i as originally parsed (a clamped, m defaulted)
+        r = src[i]
+        if isinstance(r, dict):
+            return canonical_json(r)
+        d = dict(zip(raw_header, r)); d["a"] = a_col[i]
+        if not isinstance(m_raw[i], str):
+            d["m"] = m_raw[i]
+        return canonical_json(d)
+
+    def push_row(r: Dict):  # demo rows
+        src.append(r)
+        times.append(sys.intern(r.get("time",""))); kpis.append(sys.intern(r.get("kpi","")))
+        m_raw.append(r.get("m",""))
+        a = float(r.get("a",0) or 0)
+        a_col.append(lo if a < lo else hi if a > hi else a)
+        w_col.append(float(r.get("weight",1) or 1))
 
     if args.demo:
-        rows = demo_rows(args.demo_start, args.demo_days, args.eps_a)
+        for r in demo_rows(args.demo_start, args.demo_days, args.eps_a):
+            push_row(r)
         if not args.output_csv:
             args.output_csv = "mini_calc_output.csv"
     else:
@@ -346,63 +457,89 @@ def main():
             print("[ERR] Provide input_csv and output_csv, or use --demo")
             sys.exit(2)
         with open(args.input_csv, newline="", encoding="utf-8") as f:
-            rdr = csv.DictReader(f)
-            header = [h.strip() for h in (rdr.fieldnames or [])]
-            have_mapper = "mapper" in [h.lower() for h in header]
+            rdr = csv.reader(f)
+            raw_header = next(rdr, [])
+            have_mapper = "mapper" in [h.strip().lower() for h in raw_header]
             compute_flag = (args.compute_a == "on") or (args.compute_a == "auto" and have_mapper)
-            for r in rdr:
-                r = {k: (r.get(k,"") or "").strip() for k in r.keys()}
+            # column positions keyed by the raw header names (as DictReader did);
+            # absent columns point at a trailing "" slot
+            n = len(raw_header)
+            col = {h: i for i, h in enumerate(raw_header)}
+            ix_t, ix_k, ix_m, ix_a, ix_w, ix_mapper, ix_actual = (
+                col.get(c, n) for c in ("time","kpi","m","a","weight","mapper","actual"))
+            intern = sys.intern  # time/kpi repeat heavily: share one str each
+            mappers: Dict[str, Callable] = {}  # one specialized mapper per name
+            for vals in rdr:
+                if not vals:
+                    continue
+                vals = [v.strip() for v in vals[:n]]
+                vals.extend([""] * (n + 1 - len(vals)))
                 # fill a if needed
-                a_value = r.get("a","")
+                a_value = vals[ix_a]
                 a_float = None
                 if compute_flag and (a_value == "" or a_value.lower() == "na"):
-                    a_float, _reason = compute_a_from_mapper(r, args.eps_a)
+                    name = vals[ix_mapper].lower()
+                    fn = mappers.get(name)
+                    if fn is None:
+                        fn = mappers[name] = _build_mapper(name, args.eps_a, col, n)
+                    a_float, _reason = fn(vals)
                 else:
-                    try:
-                        a_float = float(a_value)
-                    except Exception:
-                        a_float = 0.0
-                r["a"] = clamp(a_float if a_float is not None else 0.0, -1+args.eps_a, 1-args.eps_a)
+                    a_float = parse_float(a_value, 0.0)
 
                 # default m if residual mapper present
-                if r.get("m","") == "" and (r.get("mapper","") or "").lower() == "residual":
-                    try:
-                        r["m"] = float(r.get("actual","0") or 0.0)
-                    except Exception:
-                        r["m"] = 0.0
-                rows.append(r)
+                m_value = vals[ix_m]
+                if m_value == "" and vals[ix_mapper].lower() == "residual":
+                    m_value = parse_float(vals[ix_actual] or 0.0, 0.0)
+
+                src.append(vals)
+                times.append(intern(vals[ix_t])); kpis.append(intern(vals[ix_k]))
+                m_raw.append(m_value)
+                a = a_float if a_float is not None else 0.0
+                a_col.append(lo if a < lo else hi if a > hi else a)
+                w_col.append(float(vals[ix_w] or 1))
 
     # --- Group by (time,kpi); fuse a if multiple rows share the key ---
-    grouped: Dict[Tuple[str,str], List[Dict]] = defaultdict(list)
-    for r in rows:
-        key = (r.get("time",""), r.get("kpi",""))
-        grouped[key].append(r)
+    # group id per (time,kpi) in first-seen order; one pass over the columns
+    # accumulates the rapidity sums per group (order-free)
+    group_id: Dict[Tuple[str,str], int] = {}
+    num:   List[float] = []   # SUM w*atanh(a)
+    den:   List[float] = []   # SUM w
+    m_grp: List        = []   # classical m: explicit m of the canonically-first member
+    m_row: List[int]   = []   # row index holding m_grp
+    m_tie: Dict[int, List[int]] = {}  # further rows repeating the same m (before any conflict)
+    m_key: Dict[int, str] = {}        # smallest canonical_row so far, only for conflicting groups
+    atanh, tanh = math.atanh, math.tanh
+    u_col = [w * atanh(a) for a, w in zip(a_col, w_col)]
+    for i, (key, u_i, w_i, m_i) in enumerate(zip(zip(times, kpis), u_col, w_col, m_raw)):
+        g = group_id.get(key)
+        if g is None:
+            g = group_id[key] = len(num)
+            num.append(0.0); den.append(0.0); m_grp.append(None); m_row.append(-1)
+        num[g] += u_i
+        den[g] += w_i
+        m_new = parse_float(m_i)
+        if m_new is None:
+            continue
+        m_cur = m_grp[g]
+        if m_cur is None:
+            m_grp[g], m_row[g] = m_new, i
+        elif g not in m_key and repr(m_new) == repr(m_cur):
+            m_tie.setdefault(g, []).append(i)
+        else:
+            # conflicting explicit m: keep the m of the smallest canonical_json row,
+            # so the result does not depend on input row order
+            if g not in m_key:
+                m_key[g] = min(canonical_row(j) for j in [m_row[g]] + m_tie.pop(g, []))
+            k_new = canonical_row(i)
+            if k_new < m_key[g]:
+                m_grp[g], m_row[g], m_key[g] = m_new, i, k_new
 
     fused_rows: List[Dict] = []
-    for (t,k), lst in grouped.items():
-        lst_sorted = sorted(lst, key=lambda z: canonical_json(z))
-        # classical m: prefer explicit m if present; else 0.0
-        m_num = None
-        for mv in [z.get("m","") for z in lst_sorted]:
-            try:
-                m_num = float(mv); break
-            except Exception:
-                continue
-        if m_num is None: m_num = 0.0
-
-        # fuse a in rapidity space with optional weights
-        num, den = 0.0, 0.0
-        for z in lst_sorted:
-            a_i = float(z.get("a",0) or 0)
-            w_i = float(z.get("weight",1) or 1)
-            a_i = clamp(a_i, -1+args.eps_a, 1-args.eps_a)
-            num += w_i * math.atanh(a_i)
-            den += w_i
-        a_out = math.tanh(num / max(den, args.eps_w))
-
+    for (t,k), g in group_id.items():
         fused_rows.append({
             "time": t or datetime.now(timezone.utc).strftime("%Y-%m-%d"),
-            "kpi": k, "m": m_num, "a": a_out
+            "kpi": k, "m": 0.0 if m_grp[g] is None else m_grp[g],
+            "a": tanh(num[g] / max(den[g], args.eps_w))
         })
 
     # --- Per-KPI time sort, hysteresis, hash/build tags ---
@@ -414,23 +551,23 @@ def main():
     latest = {}
     for kpi, lst in by_kpi.items():
         lst.sort(key=lambda z: parse_iso(z["time"]))
-        prev_band, prev_a = None, None
-        for r in lst:
-            r["band_hyst"] = next_band(prev_band, prev_a, r["a"], args.promote, args.demote)
+        hyst = hysteresis_bands([r["a"] for r in lst], args.promote, args.demote)
+        for r, bh in zip(lst, hyst):
+            r["band_hyst"] = bh
             r["knobs_hash"] = khash
             r["build_id"] = args.build_id
-            prev_band, prev_a = r["band_hyst"], r["a"]
         latest[kpi] = lst[-1]
 
     # --- Write output CSV ---
     fieldnames = ["time","kpi","m","a","band","band_hyst","knobs_hash","build_id","stamp"]
+    # format into memory with csv.writer (keeps quoting), then one write to disk
+    buf = io.StringIO(newline="")
+    w = csv.writer(buf); w.writerow(fieldnames)
+    for kpi in sorted(by_kpi.keys()):
+        w.writerows((r["time"], r["kpi"], r["m"], f"{r['a']:.4f}", r["band"], r["band_hyst"],
+                     r["knobs_hash"], r["build_id"], "") for r in by_kpi[kpi])
     with open(args.output_csv, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames); w.writeheader()
-        for kpi in sorted(by_kpi.keys()):
-            for r in by_kpi[kpi]:
-                out = {k: r.get(k,"") for k in fieldnames}
-                out["a"] = f"{float(out['a']):.4f}"
-                w.writerow(out)
+        f.write(buf.getvalue())
 
     # --- Alerts (optional) ---
     if args.alerts_csv:
@@ -452,8 +589,9 @@ def main():
         if path: print(f"Plot saved: {path}")
 
     # --- SDI (native; purge+append) ---
+    sdi_rows = []
     if args.sdi:
-        append_sdi_rows_from_csv(
+        sdi_rows = append_sdi_rows_from_csv(
             output_csv_path=args.output_csv,
             eps_a=args.eps_a,
             sdi_kpis=args.sdi_kpis,
@@ -463,24 +601,18 @@ def main():
         )
 
     # --- Console summary ---
-    print("=== Mini Calculator Summary (latest by KPI) ===")
-    for kpi, r in latest.items():
-        print(f"{kpi}: m={r['m']}, a={float(r['a']):.4f}, band={r['band']}, band_hyst={r['band_hyst']}")
-    if args.sdi:
-        try:
-            last_sdi = None
-            with open(args.output_csv, "r", encoding="utf-8") as f:
-                for row in csv.DictReader(f):
-                    if row.get("kpi") == "SDI":
-                        last_sdi = row
-            if last_sdi:
-                print(f"\nSDI: m={last_sdi.get('m','0.0')}, a={float(last_sdi['a']):.4f}, "
-                      f"band={last_sdi.get('band')}, band_hyst={last_sdi.get('band_hyst')}")
-        except Exception:
-            pass
-
-    print(f"\nOutput written to: {args.output_csv}")
-    print(f"knobs_hash: {knobs_hash_from(knobs)}")
+    # built as one block and written once (one write for any number of KPIs)
+    lines = ["=== Mini Calculator Summary (latest by KPI) ==="]
+    lines.extend(f"{kpi}: m={r['m']}, a={float(r['a']):.4f}, band={r['band']}, band_hyst={r['band_hyst']}"
+                 for kpi, r in latest.items())
+    if sdi_rows:
+        last_sdi = sdi_rows[-1]
+        lines.append(f"\nSDI: m={last_sdi['m']}, a={float(last_sdi['a']):.4f}, "
+                     f"band={last_sdi['band']}, band_hyst={last_sdi['band_hyst']}")
+
+    lines.append(f"\nOutput written to: {args.output_csv}")
+    lines.append(f"knobs_hash: {khash}")
+    sys.stdout.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
     main()